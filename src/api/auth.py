@@ -1,10 +1,13 @@
-from flask import Blueprint, request, jsonify
-from database import Database, User, Bookmark, SearchHistory
-from functools import wraps
+from flask import Blueprint, current_app, request, jsonify, g
+from database import Database, User, Bookmark, SearchHistory, BookAnalytics, TRENDING_TTL
+from functools import wraps, lru_cache
+from collections import namedtuple
+from cachetools import TTLCache
+import base64
+import hashlib
 import os
 import jwt
 from datetime import datetime, timedelta
-import json
 
 auth_bp = Blueprint('auth', __name__)
 db = Database()
@@ -14,6 +17,51 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'doggystyle')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION = timedelta(days=1)
 
+# Build the JWT codec and HMAC key once instead of on every encode/decode
+_jwt = jwt.PyJWT()
+_jwt_key = jwt.PyJWK({
+    'kty': 'oct',
+    'k': base64.urlsafe_b64encode(JWT_SECRET.encode('utf-8')).rstrip(b'=').decode('ascii')
+}, algorithm=JWT_ALGORITHM)
+
+# Resolved tokens are cached briefly so repeat requests skip the JWT decode
+# and user lookup; keep the TTL short so expiry/deletion is picked up quickly
+AuthUser = namedtuple('AuthUser', ['id', 'username'])
+_token_cache = TTLCache(maxsize=10000, ttl=30)
+
+def _resolve_user(token: str):
+    """Decode a JWT and return the matching AuthUser, or None if the user is gone"""
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    user = _token_cache.get(key)
+    if user is not None:
+        return user
+    
+    payload = decode_token(token)
+    user = _get_user_tuple(payload['user_id'])
+    if not user:
+        return None
+    
+    _token_cache[key] = user
+    return user
+
+@lru_cache(maxsize=1024)
+def _get_user_tuple(user_id: int):
+    """Look up a user by id; usernames never change, so results are kept for the process lifetime"""
+    db_session = db.Session()
+    user = db_session.get(User, user_id)
+    return AuthUser(user.id, user.username) if user else None
+
+def _issue_token(user_id: int) -> str:
+    """Generate a signed JWT for the user"""
+    return _jwt.encode({
+        'user_id': user_id,
+        'exp': datetime.utcnow() + JWT_EXPIRATION
+    }, _jwt_key, algorithm=JWT_ALGORITHM)
+
+def decode_token(token: str) -> dict:
+    """Verify a JWT and return its payload"""
+    return _jwt.decode(token, _jwt_key, algorithms=[JWT_ALGORITHM])
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -26,17 +74,11 @@ def login_required(f):
             if token.startswith('Bearer '):
                 token = token[7:]
             
-            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-            user_id = payload['user_id']
-            
             # Verify user still exists
-            db_session = db.Session()
-            try:
-                user = db_session.query(User).filter_by(id=user_id).first()
-                if not user:
-                    return jsonify({'error': 'User not found'}), 401
-            finally:
-                db_session.close()
+            user = _resolve_user(token)
+            if not user:
+                return jsonify({'error': 'User not found'}), 401
+            g.user = user
                 
             return f(*args, **kwargs)
         except jwt.ExpiredSignatureError:
@@ -55,21 +97,14 @@ def check_auth():
         if token.startswith('Bearer '):
             token = token[7:]
         
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload['user_id']
+        user = _resolve_user(token)
+        if not user:
+            return jsonify({'error': 'User not found'}), 401
         
-        db_session = db.Session()
-        try:
-            user = db_session.query(User).filter_by(id=user_id).first()
-            if not user:
-                return jsonify({'error': 'User not found'}), 401
-            
-            return jsonify({
-                'id': user.id,
-                'username': user.username
-            })
-        finally:
-            db_session.close()
+        return jsonify({
+            'id': user.id,
+            'username': user.username
+        })
     except jwt.ExpiredSignatureError:
         return jsonify({'error': 'Token has expired'}), 401
     except jwt.InvalidTokenError:
@@ -85,34 +120,27 @@ def register():
         return jsonify({'error': 'Username and password are required'}), 400
     
     db_session = db.Session()
-    try:
-        # Check if username exists
-        existing_user = db_session.query(User).filter_by(username=username).first()
-        if existing_user:
-            return jsonify({'error': 'Username already exists'}), 409
-        
-        # Create new user
-        user = User(username=username)
-        user.set_password(password)
-        db_session.add(user)
-        db_session.commit()
-        
-        # Generate JWT token
-        token = jwt.encode({
-            'user_id': user.id,
-            'exp': datetime.utcnow() + JWT_EXPIRATION
-        }, JWT_SECRET, algorithm=JWT_ALGORITHM)
-        
-        return jsonify({
-            'message': 'User created successfully',
-            'token': token,
-            'user': {
-                'id': user.id,
-                'username': user.username
-            }
-        }), 201
-    finally:
-        db_session.close()
+    # Check if username exists
+    existing_user = db_session.query(User).filter_by(username=username).first()
+    if existing_user:
+        return jsonify({'error': 'Username already exists'}), 409
+    
+    # Create new user
+    user = User(username=username)
+    user.set_password(password)
+    db_session.add(user)
+    db_session.commit()
+    
+    token = _issue_token(user.id)
+    
+    return jsonify({
+        'message': 'User created successfully',
+        'token': token,
+        'user': {
+            'id': user.id,
+            'username': user.username
+        }
+    }), 201
 
 @auth_bp.route('/login', methods=['POST'])
 def login():
@@ -124,27 +152,36 @@ def login():
         return jsonify({'error': 'Username and password are required'}), 400
     
     db_session = db.Session()
-    try:
-        user = db_session.query(User).filter_by(username=username).first()
-        if not user or not user.check_password(password):
-            return jsonify({'error': 'Invalid username or password'}), 401
-        
-        # Generate JWT token
-        token = jwt.encode({
-            'user_id': user.id,
-            'exp': datetime.utcnow() + JWT_EXPIRATION
-        }, JWT_SECRET, algorithm=JWT_ALGORITHM)
-        
-        return jsonify({
-            'message': 'Login successful',
-            'token': token,
-            'user': {
-                'id': user.id,
-                'username': user.username
-            }
-        })
-    finally:
-        db_session.close()
+    user = db_session.query(User).filter_by(username=username).first()
+    if not user or not user.check_password(password):
+        return jsonify({'error': 'Invalid username or password'}), 401
+    
+    token = _issue_token(user.id)
+    
+    return jsonify({
+        'message': 'Login successful',
+        'token': token,
+        'user': {
+            'id': user.id,
+            'username': user.username
+        }
+    })
+
+@auth_bp.route('/refresh', methods=['POST'])
+@login_required
+def refresh():
+    """Exchange a still-valid token for a fresh one.
+    
+    Clients should call /login once per session and refresh from then on,
+    which avoids repeating the bcrypt password check.
+    """
+    return jsonify({
+        'token': _issue_token(g.user.id),
+        'user': {
+            'id': g.user.id,
+            'username': g.user.username
+        }
+    })
 
 @auth_bp.route('/logout', methods=['POST'])
 @login_required
@@ -155,11 +192,7 @@ def logout():
 @auth_bp.route('/bookmarks', methods=['GET'])
 @login_required
 def get_bookmarks():
-    token = request.headers.get('Authorization')
-    if token.startswith('Bearer '):
-        token = token[7:]
-    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-    user_id = payload['user_id']
+    user_id = g.user.id
     
     bookmarks = db.get_user_bookmarks(user_id)
     return jsonify([{
@@ -167,19 +200,14 @@ def get_bookmarks():
         'book_id': b.book_id,
         'title': b.title,
         'note': b.note,
-        'character_data': b.character_data,
-        'validation_data': b.validation_data,
-        'created_at': b.created_at.isoformat()
+        'response_data': b.response_data,
+        'created_at': b.created_at
     } for b in bookmarks])
 
 @auth_bp.route('/bookmarks', methods=['POST'])
 @login_required
 def add_bookmark():
-    token = request.headers.get('Authorization')
-    if token.startswith('Bearer '):
-        token = token[7:]
-    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-    user_id = payload['user_id']
+    user_id = g.user.id
     
     data = request.get_json()
     book_id = data.get('book_id')
@@ -206,30 +234,30 @@ def add_bookmark():
 @auth_bp.route('/trending', methods=['GET'])
 def get_trending():
     limit = request.args.get('limit', default=10, type=int)
-    trending = db.get_trending_books(limit)
-    return jsonify([{
-        'book_id': t.book_id,
-        'title': t.title,
-        'search_count': t.search_count,
-        'last_searched': t.last_searched.isoformat()
-    } for t in trending])
+    return trending_response(limit)
+
+def trending_response(limit: int):
+    """
+    Serve the cached trending body. Clients may keep it for the same TTL the
+    server cache uses, then revalidate with the ETag for a 304.
+    """
+    response = current_app.response_class(db.get_trending_json(limit), mimetype='application/json')
+    response.headers['Cache-Control'] = f'public, max-age={TRENDING_TTL}'
+    response.add_etag()
+    return response.make_conditional(request)
 
 @auth_bp.route('/bookmarks/list', methods=['GET'])
 @login_required
 def list_bookmarks():
     """Get a list of bookmarks with minimal data"""
-    token = request.headers.get('Authorization')
-    if token.startswith('Bearer '):
-        token = token[7:]
-    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-    user_id = payload['user_id']
+    user_id = g.user.id
     
-    bookmarks = db.get_user_bookmarks(user_id)
+    bookmarks = db.list_user_bookmarks(user_id)
     return jsonify([{
         'id': b.id,
         'book_id': b.book_id,
         'title': b.title,
-        'created_at': b.created_at.isoformat(),
+        'created_at': b.created_at,
         'note': b.note
     } for b in bookmarks])
 
@@ -237,54 +265,45 @@ def list_bookmarks():
 @login_required
 def get_search_history():
     """Get user's search history"""
-    token = request.headers.get('Authorization')
-    if token.startswith('Bearer '):
-        token = token[7:]
-    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-    user_id = payload['user_id']
+    user_id = g.user.id
     
     session = db.Session()
-    try:
-        searches = session.query(SearchHistory)\
-            .filter_by(user_id=user_id)\
-            .order_by(SearchHistory.search_date.desc())\
-            .all()
-        
-        return jsonify([{
-            'book_id': s.book_id,
-            'title': s.title,
-            'search_date': s.search_date.isoformat()
-        } for s in searches])
-    finally:
-        session.close()
+    # One joined query, so per-book fields never turn into N+1 lookups
+    searches = session.query(
+            SearchHistory.book_id,
+            SearchHistory.title,
+            SearchHistory.search_date,
+            BookAnalytics.search_count
+        )\
+        .outerjoin(BookAnalytics, BookAnalytics.book_id == SearchHistory.book_id)\
+        .filter(SearchHistory.user_id == user_id)\
+        .order_by(SearchHistory.search_date.desc())\
+        .yield_per(200)
+    
+    return jsonify([{
+        'book_id': s.book_id,
+        'title': s.title,
+        'search_date': s.search_date,
+        'search_count': s.search_count
+    } for s in searches])
 
 @auth_bp.route('/bookmarks/<string:bookmark_id>', methods=['GET'])
 @login_required
 def get_bookmark(bookmark_id):
     """Get full bookmark data by ID"""
-    token = request.headers.get('Authorization')
-    if token.startswith('Bearer '):
-        token = token[7:]
-    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-    user_id = payload['user_id']
+    user_id = g.user.id
     
     session = db.Session()
-    try:
-        bookmark = session.query(Bookmark).filter_by(
-            id=bookmark_id,
-            user_id=user_id
-        ).first()
+    bookmark = session.get(Bookmark, bookmark_id)
+    
+    if not bookmark or bookmark.user_id != user_id:
+        return jsonify({'error': 'Bookmark not found'}), 404
         
-        if not bookmark:
-            return jsonify({'error': 'Bookmark not found'}), 404
-            
-        return jsonify({
-            'id': bookmark.id,
-            'book_id': bookmark.book_id,
-            'title': bookmark.title,
-            'note': bookmark.note,
-            'response_data': json.loads(bookmark.response_data),
-            'created_at': bookmark.created_at.isoformat()
-        })
-    finally:
-        session.close() 
\ No newline at end of file
+    return jsonify({
+        'id': bookmark.id,
+        'book_id': bookmark.book_id,
+        'title': bookmark.title,
+        'note': bookmark.note,
+        'response_data': bookmark.response_data,
+        'created_at': bookmark.created_at
+    })
\ No newline at end of file
@@ -1,12 +1,16 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Float, Boolean
+from sqlalchemy import create_engine, event, insert, Column, Integer, String, Text, DateTime, ForeignKey, Float, Boolean, Index, JSON
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
 from datetime import datetime, timedelta
 from os import path
 import bcrypt
-import json
-from typing import Optional
+import orjson
+from typing import Iterable, Optional
 from sqlalchemy.sql import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+import threading
 import uuid
 import logging
 
@@ -15,6 +19,12 @@ logger = logging.getLogger(__name__)
 Base = declarative_base()
 ROOT = path.dirname(path.realpath(__file__))
 
+# Serialized trending lists keyed by limit; module level so every Database
+# instance in the process shares the same entries. Entries are never cleared
+# on write: trending may lag new searches by up to TRENDING_TTL seconds
+TRENDING_TTL = 60
+_trending_cache = TTLCache(maxsize=32, ttl=TRENDING_TTL)
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -38,6 +48,10 @@ class User(Base):
 
 class SearchHistory(Base):
     __tablename__ = 'search_history'
+    __table_args__ = (
+        # Serves per-user history ordered by date (and plain user_id lookups)
+        Index('ix_search_user_date', 'user_id', 'search_date'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -52,50 +66,54 @@ class Bookmark(Base):
     __tablename__ = 'bookmarks'
     
     id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
     book_id = Column(String(100), nullable=False)
     title = Column(String(200), nullable=False)
-    response_data = Column(Text, nullable=False)  # Store complete response as JSON string
+    response_data = Column(JSON, nullable=False)  # Complete analysis response
     note = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
     user = relationship("User", back_populates="bookmarks")
 
-# Remove BookAnalytics table and create a view instead
 class BookAnalytics(Base):
+    """Per-book search counters, kept up to date by Database.add_search"""
     __tablename__ = 'book_analytics'
-    __table_args__ = {'info': {'is_view': True}}
     
     book_id = Column(String(100), primary_key=True)
     title = Column(String(200), nullable=False)
-    search_count = Column(Integer, nullable=False)
+    search_count = Column(Integer, nullable=False, default=0)
     last_searched = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        Index('ix_ba_count_date', search_count.desc(), last_searched.desc()),
+    )
 
     @classmethod
-    def create_view(cls, engine):
-        """Create the analytics view"""
+    def migrate_from_view(cls, engine):
+        """Replace the legacy book_analytics view with the table, seeded from search_history"""
         try:
-            with engine.connect() as conn:                
-                # Drop view if it exists
-                conn.execute(text("DROP VIEW IF EXISTS book_analytics"))
-                conn.commit()
+            with engine.begin() as conn:
+                is_view = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'book_analytics'"
+                )).first()
+                if not is_view:
+                    return
                 
-                # Create the view
+                conn.execute(text("DROP VIEW book_analytics"))
+                cls.__table__.create(conn)
                 conn.execute(text("""
-                    CREATE VIEW book_analytics AS
+                    INSERT INTO book_analytics (book_id, title, search_count, last_searched)
                     SELECT 
                         book_id,
-                        title,
-                        COUNT(*) as search_count,
-                        MAX(search_date) as last_searched
+                        MAX(title),
+                        COUNT(*),
+                        MAX(search_date)
                     FROM search_history
-                    GROUP BY book_id, title
-                    ORDER BY search_count DESC, last_searched DESC
+                    GROUP BY book_id
                 """))
-                conn.commit()
         except Exception as e:
-            logger.error(f"Error creating book_analytics view: {str(e)}")
+            logger.error(f"Error migrating book_analytics view: {str(e)}")
             raise
 
 class SharedAnalysis(Base):
@@ -105,7 +123,7 @@ class SharedAnalysis(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     book_id = Column(String(100), nullable=False)
     title = Column(String(200), nullable=False)
-    response_data = Column(Text, nullable=False)
+    response_data = Column(JSON, nullable=False)
     note = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
     expires_at = Column(DateTime)  # Optional: Add expiration for shared links
@@ -116,136 +134,189 @@ class SharedAnalysis(Base):
 class Database:
     def __init__(self, db_filename: str = "plottheplot.db"):
         db_url = f"sqlite:///{path.join(ROOT, db_filename)}"
-        self.engine = create_engine(db_url)
-        self.Session = sessionmaker(bind=self.engine)
+        self.engine = create_engine(
+            db_url,
+            pool_size=10,
+            max_overflow=20,
+            pool_timeout=30,
+            pool_recycle=1800,
+            pool_pre_ping=True,
+            pool_use_lifo=True,
+            connect_args={"check_same_thread": False}
+        )
+        event.listen(self.engine, "connect", self._set_sqlite_pragmas)
+        # One session per thread (i.e. per request); the app removes it on teardown
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        BookAnalytics.migrate_from_view(self.engine)
         Base.metadata.create_all(self.engine)
-        # Create the view after tables are created
-        BookAnalytics.create_view(self.engine)
+        # create_all skips existing tables, so add any indexes missing from older databases
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+        # ...and drop ones nothing reads any more (the old analytics view's GROUP BY index)
+        with self.engine.begin() as conn:
+            conn.execute(text("DROP INDEX IF EXISTS ix_search_book_title"))
+    
+    @staticmethod
+    def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+        """Enable WAL so concurrent readers don't block writers"""
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        finally:
+            cursor.close()
     
     def create_user(self, username: str, password: str) -> Optional[User]:
         """Create a new user with hashed password"""
         session = self.Session()
-        try:
-            if session.query(User).filter_by(username=username).first():
-                return None
-            
-            user = User(username=username)
-            user.set_password(password)
-            session.add(user)
-            session.commit()
-            session.refresh(user)
-            return user
-        finally:
-            session.close()
+        if session.query(User).filter_by(username=username).first():
+            return None
+        
+        user = User(username=username)
+        user.set_password(password)
+        session.add(user)
+        session.commit()
+        session.refresh(user)
+        return user
     
     def authenticate_user(self, username: str, password: str) -> Optional[User]:
         """Authenticate a user and return the user object if successful"""
         session = self.Session()
-        try:
-            user = session.query(User).filter_by(username=username).first()
-            if user and user.check_password(password):
-                return user
-            return None
-        finally:
-            session.close()
+        user = session.query(User).filter_by(username=username).first()
+        if user and user.check_password(password):
+            return user
+        return None
     
     def add_search(self, user_id: int, book_id: str, title: str) -> None:
-        """Add a search to history and update the view"""
+        """Add a search to history and bump the book's analytics counters"""
+        self.add_searches_bulk([{
+            'user_id': user_id,
+            'book_id': book_id,
+            'title': title,
+            'search_date': datetime.utcnow()
+        }])
+    
+    def add_searches_bulk(self, rows: list[dict]) -> None:
+        """
+        Insert many searches at once and bump analytics counters in the same transaction.
+        Each row needs user_id, book_id, title and search_date.
+        """
+        if not rows:
+            return
         session = self.Session()
-        try:
-            search = SearchHistory(
-                user_id=user_id,
-                book_id=book_id,
-                title=title
-            )
-            session.add(search)
-            session.commit()
-            # Recreate view after adding new search
-            BookAnalytics.create_view(self.engine)
-        finally:
-            session.close()
+        session.execute(insert(SearchHistory), rows)
+        
+        # One counter update per book, carrying the latest title and time
+        per_book = {}
+        for row in sorted(rows, key=lambda r: r['search_date']):
+            entry = per_book.setdefault(row['book_id'], {'book_id': row['book_id'], 'search_count': 0})
+            entry['search_count'] += 1
+            entry['title'] = row['title']
+            entry['last_searched'] = row['search_date']
+        
+        upsert = sqlite_insert(BookAnalytics)
+        session.execute(upsert.on_conflict_do_update(
+            index_elements=[BookAnalytics.book_id],
+            set_={
+                'title': upsert.excluded.title,
+                'search_count': BookAnalytics.search_count + upsert.excluded.search_count,
+                'last_searched': upsert.excluded.last_searched
+            }
+        ), list(per_book.values()))
+        session.commit()
     
     def add_bookmark(self, user_id: int, book_id: str, title: str, response_data: dict, note: Optional[str] = None) -> Bookmark:
         """Add a new bookmark"""
         session = self.Session()
-        try:
-            bookmark = Bookmark(
-                user_id=user_id,
-                book_id=book_id,
-                title=title,
-                response_data=json.dumps(response_data),
-                note=note
-            )
-            session.add(bookmark)
-            session.commit()
-            # Refresh the object to get the generated UUID
-            session.refresh(bookmark)
-            return bookmark
-        finally:
-            session.close()
+        bookmark = Bookmark(
+            user_id=user_id,
+            book_id=book_id,
+            title=title,
+            response_data=response_data,
+            note=note
+        )
+        session.add(bookmark)
+        session.commit()
+        # Refresh the object to get the generated UUID
+        session.refresh(bookmark)
+        return bookmark
     
     def get_user_bookmarks(self, user_id: int) -> list[Bookmark]:
         """Get all bookmarks for a user"""
         session = self.Session()
-        try:
-            return session.query(Bookmark).filter_by(user_id=user_id).all()
-        finally:
-            session.close()
+        return session.query(Bookmark).filter_by(user_id=user_id).all()
+    
+    def list_user_bookmarks(self, user_id: int) -> Iterable:
+        """
+        Get bookmark summaries for a user without loading response_data.
+        Rows are fetched in batches while iterating, so iterate within the request.
+        """
+        session = self.Session()
+        return session.query(
+            Bookmark.id,
+            Bookmark.book_id,
+            Bookmark.title,
+            Bookmark.created_at,
+            Bookmark.note
+        ).filter_by(user_id=user_id).yield_per(500)
     
     def get_trending_books(self, limit: int = 10) -> list[BookAnalytics]:
-        """Get trending books from the view"""
+        """Get the most searched books"""
         session = self.Session()
-        try:
-            return session.query(BookAnalytics)\
-                .order_by(BookAnalytics.search_count.desc(), BookAnalytics.last_searched.desc())\
-                .limit(limit)\
-                .all()
-        finally:
-            session.close()
+        return session.query(BookAnalytics)\
+            .order_by(BookAnalytics.search_count.desc(), BookAnalytics.last_searched.desc())\
+            .limit(limit)\
+            .all()
+    
+    @cached(_trending_cache, key=lambda self, limit=10: hashkey(limit), lock=threading.Lock())
+    def get_trending_json(self, limit: int = 10) -> bytes:
+        """Get trending books as a ready-to-send JSON body, cached briefly"""
+        return orjson.dumps([{
+            'book_id': t.book_id,
+            'title': t.title,
+            'search_count': t.search_count,
+            'last_searched': t.last_searched
+        } for t in self.get_trending_books(limit)], option=orjson.OPT_NAIVE_UTC)
     
     def create_shared_analysis(self, user_id: int, book_id: str, title: str, response_data: dict, note: Optional[str] = None, expires_in_days: Optional[int] = None) -> SharedAnalysis:
         """Create a new shared analysis link"""
         session = self.Session()
-        try:
-            expires_at = None
-            if expires_in_days:
-                expires_at = datetime.utcnow() + timedelta(days=expires_in_days)
-            
-            shared = SharedAnalysis(
-                user_id=user_id,
-                book_id=book_id,
-                title=title,
-                response_data=json.dumps(response_data),
-                note=note,
-                expires_at=expires_at
-            )
-            session.add(shared)
-            session.commit()
-            session.refresh(shared)
-            return shared
-        finally:
-            session.close()
+        expires_at = None
+        if expires_in_days:
+            expires_at = datetime.utcnow() + timedelta(days=expires_in_days)
+        
+        shared = SharedAnalysis(
+            user_id=user_id,
+            book_id=book_id,
+            title=title,
+            response_data=response_data,
+            note=note,
+            expires_at=expires_at
+        )
+        session.add(shared)
+        session.commit()
+        session.refresh(shared)
+        return shared
     
     def get_shared_analysis(self, share_id: str) -> Optional[dict]:
         """Get a shared analysis by ID"""
         session = self.Session()
-        try:
-            shared = session.query(SharedAnalysis).filter_by(id=share_id).first()
-            if not shared:
-                return None
-            
-            # Check if expired
-            if shared.expires_at and shared.expires_at < datetime.utcnow():
-                return None
-            
-            return {
-                'id': shared.id,
-                'book_id': shared.book_id,
-                'title': shared.title,
-                'response_data': json.loads(shared.response_data),
-                'note': shared.note,
-                'created_at': shared.created_at.isoformat(),
-                'shared_by': shared.user.username
-            }
-        finally:
-            session.close() 
\ No newline at end of file
+        shared = session.get(SharedAnalysis, share_id)
+        if not shared:
+            return None
+        
+        # Check if expired
+        if shared.expires_at and shared.expires_at < datetime.utcnow():
+            return None
+        
+        return {
+            'id': shared.id,
+            'book_id': shared.book_id,
+            'title': shared.title,
+            'response_data': shared.response_data,
+            'note': shared.note,
+            'created_at': shared.created_at,
+            'expires_at': shared.expires_at,
+            'shared_by': shared.user.username
+        }
\ No newline at end of file
@@ -0,0 +1,17 @@
+# Production server config: gunicorn -c gunicorn.conf.py index:app (run from src/api)
+#
+# /api/analyze spends most of its time waiting on Gutenberg and Gemini, so
+# gevent workers let each process keep hundreds of requests in flight instead
+# of one per thread. The gevent worker monkey-patches the stdlib before the
+# app is imported, so requests, threading and the thread pools cooperate.
+# C extensions that do their own I/O are not patched: that's why the Gemini
+# client is configured with the REST transport instead of gRPC (see index.py).
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5328')
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_connections = 500
+# An analysis may take up to ANALYZE_TIMEOUT (300s, see index.py) including
+# Gemini retries; keep the worker timeout above that budget
+timeout = 330
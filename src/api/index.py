@@ -1,18 +1,35 @@
+import io
 import os
+import re
+import hashlib
 import time
-import json
+import queue
+import atexit
+import threading
 import requests
 import logging
-from flask import Flask, request, jsonify
+import orjson
+from types import MappingProxyType
+from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from flask import Flask, request, jsonify, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import jwt
-from auth import JWT_SECRET, JWT_ALGORITHM
 from datetime import datetime, timedelta
+from cachetools import LRUCache
 
 import google.generativeai as genai
-from bs4 import BeautifulSoup
-from auth import auth_bp
-from database import Database
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+import lxml.html
+from lxml import etree
+from diskcache import Cache
+from auth import auth_bp, db, login_required, trending_response
+from database import ROOT
+from circuit_breaker import CircuitOpenError, get_breaker
 
 # Configure logging
 logging.basicConfig(
@@ -25,7 +42,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Serve JSON with orjson; datetimes are encoded natively as UTC ISO 8601"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Configure CORS
 CORS(app, 
@@ -37,273 +64,669 @@ CORS(app,
 app.secret_key = os.environ.get('SECRET_KEY', 'doggystyle')
 app.register_blueprint(auth_bp, url_prefix='/api/auth')
 
-db = Database()
+@app.teardown_request
+def remove_db_session(exc):
+    db.Session.remove()
 
 # JWT Configuration
 JWT_EXPIRATION = timedelta(days=1)
 
-class PlotThePlot:
-    def __init__(self, api_key: str, model_name: str = "gemini-2.0-flash"):
-        self.api_key = api_key
-        self.model_name = model_name
-        self.max_retries = 5
-        self.retry_delay = 5
+# Gutenberg texts and metadata effectively never change for a given book ID;
+# texts are revalidated with a conditional GET once older than this so upstream
+# corrections are picked up without re-downloading unchanged books
+GUTENBERG_TEXT_TTL = 30 * 24 * 60 * 60
+gutenberg_cache = Cache(os.environ.get('GUTENBERG_CACHE_DIR', os.path.join(ROOT, "gutenberg_cache")))
 
-    def get_schema(self):
-        """
-        Define the JSON schema that we want Gemini to produce.
-        'positivity' is removed; 'key_dialogs' is added for each relationship.
-        """
-        return {
-            "type": "OBJECT",
-            "properties": {
-                "characters": {
-                    "type": "ARRAY",
-                    "description": "Extracted characters from the text.",
-                    "items": {
-                        "type": "OBJECT",
-                        "properties": {
-                            "id": {
-                                "type": "NUMBER",
-                                "description": "Unique integer identifying each character"
-                            },
-                            "common_name": {
-                                "type": "STRING",
-                                "description": "The primary or most frequent name"
-                            },
-                            "main_character": {
-                                "type": "BOOLEAN",
-                                "description": "True if major character in the story"
-                            },
-                            "names": {
-                                "type": "ARRAY",
-                                "description": "All known aliases, nicknames, or titles",
-                                "items": {"type": "STRING"}
-                            },
-                            "traits": {
-                                "type": "ARRAY",
-                                "description": "Key personality traits or defining characteristics of the character (e.g. brave, manipulative, loyal)",
-                                "items": {"type": "STRING"}
-                            },
-                            "description": {
-                                "type": "STRING",
-                                "description": "Brief summary of this character's role"
-                            }
-                        },
-                        "required": ["id", "common_name", "main_character", "names"]
+# Shared HTTP session so Gutenberg fetches reuse pooled keep-alive connections
+DEFAULT_HTTP_TIMEOUT = (5, 30)  # (connect, read) seconds
+GEMINI_REQUEST_TIMEOUT = 120  # per generate_content call
+# Budget for one /api/analyze request: no Gemini attempt starts after it and
+# each attempt's timeout is capped at what's left. Keep gunicorn's timeout above it
+ANALYZE_TIMEOUT = 300
+_gutenberg_session = requests.Session()
+_gutenberg_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
+_gutenberg_session.headers.update({
+    "User-Agent": "PlotThePlot/1.0",
+    "Accept-Encoding": "gzip, deflate"
+})
+# Fail fast while Gutenberg is down instead of tying up workers on timeouts
+_gutenberg_breaker = get_breaker(
+    "gutenberg",
+    failure_threshold=5,
+    recovery_timeout=30,
+    failure_exceptions=(requests.RequestException,)
+)
+_probe_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="gutenberg-probe")
+
+# Gemini responses keyed by model, prompt version and input, so repeat
+# analyses of the same book skip the LLM; bump PROMPT_VERSION when prompts change
+PROMPT_VERSION = "v2"
+LLM_CACHE_TTL = 30 * 24 * 60 * 60
+llm_cache = Cache(os.environ.get('LLM_CACHE_DIR', os.path.join(ROOT, "llm_cache")))
+
+_SENTENCE_END = re.compile(r'[.!?]["\'\u201d\u2019]?\s')
+
+# Only the story itself is sent to Gemini: the Project Gutenberg license
+# header/footer is stripped and the text capped at MAX_TEXT_CHARS
+MAX_TEXT_CHARS = int(os.environ.get('MAX_TEXT_CHARS', 120_000))
+GUTENBERG_HEADER_ALLOWANCE = 20_000
+_GUTENBERG_START = re.compile(r"\*\*\*\s*START OF.*?\*\*\*", re.DOTALL)
+_GUTENBERG_END = re.compile(r"\*\*\*\s*END OF.*?\*\*\*", re.DOTALL)
+
+# Runs independent blocking steps of a request (HTTP, Gemini) side by side
+_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="analyze")
+
+# Search history is written off the request path: analyze enqueues a row and
+# a daemon thread flushes whatever has arrived within SEARCH_FLUSH_INTERVAL
+SEARCH_BATCH_SIZE = 100
+SEARCH_FLUSH_INTERVAL = 0.1
+_search_queue = queue.Queue()
+
+def _drain_searches() -> None:
+    while True:
+        rows = [_search_queue.get()]
+        deadline = time.monotonic() + SEARCH_FLUSH_INTERVAL
+        while len(rows) < SEARCH_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(_search_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush_searches(rows)
+
+def _flush_searches(rows: list[dict]) -> None:
+    try:
+        db.add_searches_bulk(rows)
+    except Exception as e:
+        logger.error(f"Failed to record {len(rows)} searches: {str(e)}", exc_info=True)
+    finally:
+        db.Session.remove()
+
+@atexit.register
+def _flush_pending_searches() -> None:
+    """Write out anything still queued when the process shuts down"""
+    rows = []
+    while True:
+        try:
+            rows.append(_search_queue.get_nowait())
+        except queue.Empty:
+            break
+    if rows:
+        _flush_searches(rows)
+
+threading.Thread(target=_drain_searches, name="search-writer", daemon=True).start()
+
+# Shared analyses are immutable, so their serialized bodies and ETags are kept
+# in memory (share_id -> (etag, body, expires_at)) and repeat reads skip the DB
+SHARE_MAX_AGE = 3600
+_share_cache = LRUCache(maxsize=512)
+_share_cache_lock = threading.Lock()
+
+# Bulkhead: cap concurrent Gemini calls per process so a burst of analyses
+# can't exhaust the API quota or every worker connection at once
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', 16))
+_gemini_slots = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+
+# Errors worth retrying: rate limits, overload, timeouts and dropped
+# connections. Anything else (bad request, auth) fails fast. The client uses
+# the REST transport (see PlotThePlot), so network failures surface as
+# requests exceptions rather than gRPC ones
+TRANSIENT_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+# Wraps whole generate_json calls, so it counts one failure per call whose
+# retries were exhausted; one unlucky request can't open it for everyone
+_gemini_breaker = get_breaker(
+    "gemini",
+    failure_threshold=5,
+    recovery_timeout=30,
+    failure_exceptions=TRANSIENT_GEMINI_ERRORS
+)
+
+# Static instructions go first and are byte-identical on every call so
+# Gemini's implicit prefix caching can reuse them; only the tail varies
+_PROMPT_PREFIX = (
+    "You are a story analyser/writer in a big production house. Read the following story and identify:\n\n"
+    "1. Characters: Provide an array 'characters' with:\n"
+    "   - id (int), common_name, main_character (bool), names (array of strings), description (brief), and a list of core traits (array of strings).\n\n"
+    "2. Relations: Provide an array 'relations' with:\n"
+    "   - id1, id2 (the character IDs),\n"
+    "   - id1_to_id2_role: how id1 relates to id2 (e.g., 'father', 'mentor', 'enemy').\n"
+    "   - id2_to_id1_role: how id2 sees id1 (e.g., 'son', 'disciple', 'rival').\n"
+    "   - key_dialogs: up to two direct quotes (verbatim lines) exchanged between the two characters that are:\n"
+    "       - Famous, memorable, widely cited or emotionally significant\n"
+    "       - Central to the relationship's arc or turning points in the story\n"
+    "       - Representative of tension, affection, conflict, or a major plot event\n\n"
+    "3. Summary: The 'summary' should be a human-readable text block that includes the main plot, key players, and act-wise breakdown — written in clear prose (no JSON, lists or underscored names).\n"
+    "Return valid JSON with exactly 'characters', 'relations' and 'summary'. No extra commentary.\n\nTEXT:\n"
+)
+
+_VALIDATION_PROMPT_PREFIX = (
+    "You are an expert literary analyst.\n\n"
+    "Based on the story named below, validate the extracted information:\n"
+    "- Are the characters and relationships correctly reflected in the story?\n"
+    "- Are any hallucinated (non-existent) elements present?\n"
+    "- Are you familiar with the story and can verify the accuracy of this analysis?\n\n"
+    "Return only a JSON object like this:\n"
+    "{\n  known_story: true or false,\n  issues: [list of hallucinated, missing, or inaccurate elements],\n  notes: a brief comment on the overall accuracy,\n  score: integer between 0 and 10\n}\n\n"
+)
+
+# Function-calling schemas; read-only views since they're shared by every call
+_ANALYZE_SCHEMA = MappingProxyType({
+    "type": "OBJECT",
+    "properties": {
+        "characters": {
+            "type": "ARRAY",
+            "description": "Extracted characters from the text.",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "id": {
+                        "type": "NUMBER",
+                        "description": "Unique integer identifying each character"
+                    },
+                    "common_name": {
+                        "type": "STRING",
+                        "description": "The primary or most frequent name"
+                    },
+                    "main_character": {
+                        "type": "BOOLEAN",
+                        "description": "True if major character in the story"
+                    },
+                    "names": {
+                        "type": "ARRAY",
+                        "description": "All known aliases, nicknames, or titles",
+                        "items": {"type": "STRING"}
+                    },
+                    "traits": {
+                        "type": "ARRAY",
+                        "description": "Key personality traits or defining characteristics of the character (e.g. brave, manipulative, loyal)",
+                        "items": {"type": "STRING"}
+                    },
+                    "description": {
+                        "type": "STRING",
+                        "description": "Brief summary of this character's role"
                     }
                 },
-                "relations": {
-                    "type": "ARRAY",
-                    "description": "List of relationships among characters.",
-                    "items": {
-                        "type": "OBJECT",
-                        "properties": {
-                            "id1": {
-                                "type": "NUMBER",
-                                "description": "ID of the first character"
-                            },
-                            "id2": {
-                                "type": "NUMBER",
-                                "description": "ID of the second character"
-                            },
-                            "id1_to_id2_role": {
-                                "type": "STRING",
-                                "description": "Role of id1 toward id2 (e.g., 'father', 'mentor', 'enemy')"
-                            },
-                            "id2_to_id1_role": {
-                                "type": "STRING",
-                                "description": "Role of id2 toward id1 (e.g., 'son', 'disciple', 'rival')"
-                            },
-                            "weight": {
-                                "type": "NUMBER",
-                                "description": "Strength or importance of the relationship (1 to 10)"
-                            },
-                            "key_dialogs": {
-                                "type": "ARRAY",
-                                "description": "Up to two short lines or dialogues from the text that highlight significance",
-                                "items": {"type": "STRING"}
-                            }
-                        },
-                        "required": ["id1", "id2", "id1_to_id2_role", "id2_to_id1_role", "weight", "key_dialogs"]
+                "required": ["id", "common_name", "main_character", "names"]
+            }
+        },
+        "relations": {
+            "type": "ARRAY",
+            "description": "List of relationships among characters.",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "id1": {
+                        "type": "NUMBER",
+                        "description": "ID of the first character"
+                    },
+                    "id2": {
+                        "type": "NUMBER",
+                        "description": "ID of the second character"
+                    },
+                    "id1_to_id2_role": {
+                        "type": "STRING",
+                        "description": "Role of id1 toward id2 (e.g., 'father', 'mentor', 'enemy')"
+                    },
+                    "id2_to_id1_role": {
+                        "type": "STRING",
+                        "description": "Role of id2 toward id1 (e.g., 'son', 'disciple', 'rival')"
+                    },
+                    "weight": {
+                        "type": "NUMBER",
+                        "description": "Strength or importance of the relationship (1 to 10)"
+                    },
+                    "key_dialogs": {
+                        "type": "ARRAY",
+                        "description": "Up to two short lines or dialogues from the text that highlight significance",
+                        "items": {"type": "STRING"}
                     }
                 },
-                "summary": {
-                    "type": "STRING",
-                    "description": "(A single human-readable paragraph or multi-paragraph block of plain text) A detailed natural language summary of the story including the main plot, key players, and act-level breakdown"
-                }
-            },
-            "required": ["characters", "relations", "summary"]
+                "required": ["id1", "id2", "id1_to_id2_role", "id2_to_id1_role", "weight", "key_dialogs"]
+            }
+        },
+        "summary": {
+            "type": "STRING",
+            "description": "(A single human-readable paragraph or multi-paragraph block of plain text) A detailed natural language summary of the story including the main plot, key players, and act-level breakdown"
         }
+    },
+    "required": ["characters", "relations", "summary"]
+})
 
-    def create_prompt(self, text: str) -> str:
-        return (
-            "You are a story analyser/writer in a big production house. Read the following story and identify:\n\n"
-            "1. Characters: Provide an array 'characters' with:\n"
-            "   - id (int), common_name, main_character (bool), names (array of strings), description (brief), and a list of core traits (array of strings).\n\n"
-            "2. Relations: Provide an array 'relations' with:\n"
-            "   - id1, id2 (the character IDs),\n"
-            "   - id1_to_id2_role: how id1 relates to id2 (e.g., 'father', 'mentor', 'enemy').\n"
-            "   - id2_to_id1_role: how id2 sees id1 (e.g., 'son', 'disciple', 'rival').\n"
-            "   - key_dialogs: up to two direct quotes (verbatim lines) exchanged between the two characters that are:\n"
-            "       - Famous, memorable, widely cited or emotionally significant\n"
-            "       - Central to the relationship's arc or turning points in the story\n"
-            "       - Representative of tension, affection, conflict, or a major plot event\n\n"
-            "3. Summary: The 'summary' should be a human-readable text block that includes the main plot, key players, and act-wise breakdown — written in clear prose (no JSON, lists or underscored names).\n"
-            "Return valid JSON with exactly 'characters', 'relations' and 'summary'. No extra commentary.\n\nTEXT:\n" + text
+_VALIDATION_SCHEMA = MappingProxyType({
+    "type": "OBJECT",
+    "properties": {
+        "known_story": {
+            "type": "BOOLEAN",
+            "description": "Whether the model recognizes and is familiar with the story"
+        },
+        "issues": {
+            "type": "ARRAY",
+            "description": "List of hallucinations, inaccuracies, or missing elements in the structured JSON",
+            "items": {
+                "type": "STRING"
+            }
+        },
+        "notes": {
+            "type": "STRING",
+            "description": "General comments on the quality and accuracy of the JSON"
+        },
+        "score": {
+            "type": "INTEGER",
+            "description": "Quality score between 0 and 10 indicating overall correctness and completeness"
+        }
+    },
+    "required": ["known_story", "issues", "notes", "score"]
+})
+
+_backoff = wait_random_exponential(multiplier=1, max=60)
+# Don't start a retry with less time than this left before the deadline
+GEMINI_MIN_ATTEMPT_TIME = 5
+
+def _budget_left(retry_state) -> float:
+    return retry_state.kwargs['deadline'] - time.monotonic()
+
+def _out_of_budget(retry_state) -> bool:
+    return _budget_left(retry_state) < GEMINI_MIN_ATTEMPT_TIME
+
+def _backoff_within_deadline(retry_state) -> float:
+    # Leave room for one real attempt after sleeping, so giving up re-raises
+    # Gemini's own error rather than an empty-budget timeout
+    return max(0, min(_backoff(retry_state), _budget_left(retry_state) - GEMINI_MIN_ATTEMPT_TIME))
+
+# Full-jitter exponential backoff, capped at 60s and at the request deadline.
+# Malformed responses (no function call) are retried too since the model is
+# sampled at temperature 0.8
+@retry(
+    stop=stop_after_attempt(5) | _out_of_budget,
+    wait=_backoff_within_deadline,
+    retry=retry_if_exception_type(TRANSIENT_GEMINI_ERRORS + (ValueError,)),
+    reraise=True
+)
+def _generate_json_with_retries(model, prompt: str, *, deadline: float) -> dict:
+    remaining = deadline - time.monotonic()
+    # Running out of budget isn't Gemini's fault, so it's neither retried nor a breaker failure
+    if remaining <= 0 or not _gemini_slots.acquire(timeout=remaining):
+        raise TimeoutError("Analysis time budget exhausted")
+    try:
+        remaining = deadline - time.monotonic()
+        result = model.generate_content(
+            prompt,
+            tool_config={'function_calling_config': 'ANY'},
+            request_options={'timeout': max(1, min(GEMINI_REQUEST_TIMEOUT, remaining))}
         )
+    finally:
+        _gemini_slots.release()
+    try:
+        fc = result.candidates[0].content.parts[0].function_call
+        parsed = type(fc).to_dict(fc)["args"]
+    except (IndexError, KeyError, AttributeError) as e:
+        raise ValueError("Response did not contain a function call.") from e
+    if not isinstance(parsed, dict):
+        raise ValueError("Response is not a JSON object.")
+    return parsed
 
-    def analyze_text(self, text: str):
-        genai.configure(api_key=self.api_key)
-        schema = self.get_schema()
-        function_decl = genai.protos.FunctionDeclaration(
+def generate_json(model, prompt: str, *, deadline: float) -> dict:
+    """
+    Call Gemini with forced function calling and return the call's arguments.
+    `deadline` is a time.monotonic() value shared by every call of the request.
+    """
+    return _gemini_breaker.call(_generate_json_with_retries, model, prompt, deadline=deadline)
+
+class PlotThePlot:
+    def __init__(self, api_key: str, model_name: str = "gemini-2.0-flash"):
+        self.api_key = api_key
+        self.model_name = model_name
+        # REST rather than the default gRPC: it goes through requests, which
+        # gevent workers monkey-patch, so a slow call doesn't stall the worker
+        genai.configure(api_key=self.api_key, transport="rest")
+        
+        # Nothing below depends on the input text, so build it all once
+        self._analyze_schema = self.get_schema()
+        self._analyze_fn_decl = genai.protos.FunctionDeclaration(
             name="return_json",
             description="Return JSON with characters and relationships",
-            parameters=schema
+            parameters=dict(self._analyze_schema)
         )
-        model = genai.GenerativeModel(
+        self._analyze_model = genai.GenerativeModel(
             model_name=self.model_name,
             generation_config={"temperature": 0.8},
-            tools=[function_decl]
+            tools=[self._analyze_fn_decl]
         )
-        prompt = self.create_prompt(text)
-        for attempt in range(self.max_retries):
-            try:
-                result = model.generate_content(prompt, tool_config={'function_calling_config': 'ANY'})
-                fc = result.candidates[0].content.parts[0].function_call
-                parsed = type(fc).to_dict(fc)["args"]
-                if not isinstance(parsed, dict):
-                    raise ValueError("Response is not a JSON object.")
-                return parsed
-            except Exception as e:
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                else:
-                    raise
+        
+        self._validate_schema = self.get_validation_schema()
+        self._validate_fn_decl = genai.protos.FunctionDeclaration(
+            name="return_json",
+            description="Validate output",
+            parameters=dict(self._validate_schema)
+        )
+        self._validate_model = genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config={"temperature": 0.8},
+            tools=[self._validate_fn_decl]
+        )
+
+    def get_schema(self):
+        """
+        Define the JSON schema that we want Gemini to produce.
+        'positivity' is removed; 'key_dialogs' is added for each relationship.
+        """
+        return _ANALYZE_SCHEMA
+
+    def create_prompt(self, text: str) -> str:
+        return _PROMPT_PREFIX + truncate_at_sentence(text, MAX_TEXT_CHARS)
+
+    def analyze_text(self, text: str, refresh: bool = False, deadline: Optional[float] = None):
+        cache_key = llm_cache_key("analyze", self.model_name, hashlib.sha256(text.encode('utf-8')).hexdigest())
+        if not refresh:
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        deadline = deadline or time.monotonic() + ANALYZE_TIMEOUT
+        parsed = generate_json(self._analyze_model, self.create_prompt(text), deadline=deadline)
+        llm_cache.set(cache_key, parsed, expire=LLM_CACHE_TTL)
+        return parsed
 
     def get_validation_schema(self):
         """
         Defines the JSON schema used by the Gemini model to validate the structured character/relationship data.
         """
-        return {
-            "type": "OBJECT",
-            "properties": {
-                "known_story": {
-                    "type": "BOOLEAN",
-                    "description": "Whether the model recognizes and is familiar with the story"
-                },
-                "issues": {
-                    "type": "ARRAY",
-                    "description": "List of hallucinations, inaccuracies, or missing elements in the structured JSON",
-                    "items": {
-                        "type": "STRING"
-                    }
-                },
-                "notes": {
-                    "type": "STRING",
-                    "description": "General comments on the quality and accuracy of the JSON"
-                },
-                "score": {
-                    "type": "INTEGER",
-                    "description": "Quality score between 0 and 10 indicating overall correctness and completeness"
-                }
-            },
-            "required": ["known_story", "issues", "notes", "score"]
-        }
+        return _VALIDATION_SCHEMA
 
-    def validate_json(self, story_text: str, generated_json: dict, metadata: dict):
-        genai.configure(api_key=self.api_key)
+    def validate_json(self, story_text: str, generated_json: dict, metadata: dict, refresh: bool = False,
+                      deadline: Optional[float] = None):
+        # Compact output: Gemini doesn't need indentation and it costs tokens
+        generated = orjson.dumps(generated_json).decode()
+        cache_key = llm_cache_key("validate", self.model_name, metadata['title'], metadata['author'], generated)
+        if not refresh:
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
         prompt = (
-            "You are an expert literary analyst.\n\n"
-            f"Based on the story '{metadata['title']}' by {metadata['author']}', validate the extracted information below"
-            "- Are the characters and relationships correctly reflected in the story?\n"
-            "- Are any hallucinated (non-existent) elements present?\n"
-            "- Are you familiar with the story and can verify the accuracy of this analysis?\n\n"
-            "Return only a JSON object like this:\n"
-            "{\n  known_story: true or false,\n  issues: [list of hallucinated, missing, or inaccurate elements],\n  notes: a brief comment on the overall accuracy,\n  score: integer between 0 and 10\n}\n\n"
-            "STORY:\n" + story_text[:8000] + "\n\nSTRUCTURED_JSON:\n" + json.dumps(generated_json, indent=2)
-        )
-        schema = self.get_validation_schema()
-        function_decl = genai.protos.FunctionDeclaration(
-            name="return_json",
-            description="Validate output",
-            parameters=schema
+            _VALIDATION_PROMPT_PREFIX +
+            f"STORY TITLE: {metadata['title']}\nAUTHOR: {metadata['author']}\n\n"
+            "STORY:\n" + truncate_at_sentence(story_text, 8000) + "\n\nSTRUCTURED_JSON:\n" + generated
         )
-        model = genai.GenerativeModel(
-            model_name=self.model_name,
-            generation_config={"temperature": 0.8},
-            tools=[function_decl]
-        )
-        for attempt in range(self.max_retries):
-            try:
-                result = model.generate_content(prompt, tool_config={'function_calling_config': 'ANY'})
-                fc = result.candidates[0].content.parts[0].function_call
-                parsed = type(fc).to_dict(fc)["args"]
-                return parsed
-            except Exception as e:
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                else:
-                    raise
-
-def fetch_gutenberg_text(book_id: int) -> str:
+        deadline = deadline or time.monotonic() + ANALYZE_TIMEOUT
+        parsed = generate_json(self._validate_model, prompt, deadline=deadline)
+        llm_cache.set(cache_key, parsed, expire=LLM_CACHE_TTL)
+        return parsed
+
+def llm_cache_key(namespace: str, *parts: str) -> str:
+    """Build a fixed-length cache key for a Gemini call from its inputs"""
+    material = "|".join((namespace, PROMPT_VERSION) + parts)
+    return hashlib.blake2b(material.encode('utf-8')).hexdigest()
+
+def truncate_at_sentence(text: str, limit: int) -> str:
+    """Cut text to at most `limit` characters, ending on a sentence boundary when possible"""
+    if len(text) <= limit:
+        return text
+    head = text[:limit]
+    last_end = None
+    for last_end in _SENTENCE_END.finditer(head):
+        pass
+    return head[:last_end.end()] if last_end else head
+
+def fetch_gutenberg_text(book_id: int, refresh: bool = False) -> str:
+    cache_key = f"txt:{book_id}"
+    cached = gutenberg_cache.get(cache_key)
+    if isinstance(cached, dict):
+        age = datetime.utcnow() - cached["fetched_at"]
+        if not refresh and age < timedelta(seconds=GUTENBERG_TEXT_TTL):
+            return cached["text"]
+        try:
+            text = revalidate_gutenberg_text(cache_key, cached)
+        except (requests.RequestException, CircuitOpenError) as e:
+            # A stale copy beats failing a book we already have
+            logger.warning(f"Revalidating book {book_id} failed, serving cached text: {str(e)}")
+            return cached["text"]
+        if text is not None:
+            return text
+    
     fallback_url = f"https://www.gutenberg.org/files/{book_id}/{book_id}-0.txt"
     primary_url = f"https://www.gutenberg.org/files/{book_id}/{book_id}.txt"
-    resp = requests.get(primary_url)
-    if resp.status_code == 200:
-        return resp.text
-    resp_fallback = requests.get(fallback_url)
-    if resp_fallback.status_code == 200:
-        return resp_fallback.text
-    raise ValueError("Could not fetch text from Project Gutenberg.")
+    # Many books only exist under one of the two names, so race cheap HEAD
+    # probes for both and download only the winner
+    futures = {
+        _probe_pool.submit(
+            _gutenberg_breaker.call, _gutenberg_session.head, url,
+            allow_redirects=True, timeout=DEFAULT_HTTP_TIMEOUT
+        ): url
+        for url in (primary_url, fallback_url)
+    }
+    text_url = None
+    error = None
+    for future in as_completed(futures):
+        try:
+            probe = future.result()
+        except requests.RequestException as e:
+            error = e
+            continue
+        if probe.status_code == 200:
+            text_url = probe.url
+            # The name we asked for, not where it redirected, tells the charset
+            charset = gutenberg_charset(futures[future])
+            break
+    for future in futures:
+        future.cancel()
+    
+    if text_url is None:
+        if error is not None:
+            raise error
+        raise ValueError("Could not fetch text from Project Gutenberg.")
+    
+    resp = _gutenberg_breaker.call(_gutenberg_session.get, text_url, stream=True, timeout=DEFAULT_HTTP_TIMEOUT)
+    with resp:
+        if resp.status_code != 200:
+            raise ValueError("Could not fetch text from Project Gutenberg.")
+        return store_gutenberg_text(cache_key, text_url, resp, charset)
+
+def gutenberg_charset(url: str) -> str:
+    """Gutenberg's -0.txt files are UTF-8; the older plain .txt files are Latin-1"""
+    return "utf-8" if url.endswith("-0.txt") else "latin-1"
+
+def revalidate_gutenberg_text(cache_key: str, cached: dict) -> Optional[str]:
+    """
+    Re-check a cached text with a conditional GET. Returns the (possibly
+    re-downloaded) text, or None if the book has to be located again.
+    """
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    
+    resp = _gutenberg_breaker.call(
+        _gutenberg_session.get, cached["url"], headers=headers,
+        stream=True, timeout=DEFAULT_HTTP_TIMEOUT
+    )
+    with resp:
+        if resp.status_code == 304:
+            gutenberg_cache.set(cache_key, dict(cached, fetched_at=datetime.utcnow()), expire=None)
+            return cached["text"]
+        if resp.status_code != 200:
+            return None
+        charset = cached.get("charset") or gutenberg_charset(cached["url"])
+        return store_gutenberg_text(cache_key, cached["url"], resp, charset)
+
+def store_gutenberg_text(cache_key: str, url: str, resp, charset: str) -> str:
+    """Read a text response and cache it with what's needed to revalidate it"""
+    text = read_story_text(resp, charset)
+    # Kept past GUTENBERG_TEXT_TTL on purpose: stale entries are revalidated, not refetched
+    gutenberg_cache.set(cache_key, {
+        "text": text,
+        "url": url,
+        "charset": charset,
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "fetched_at": datetime.utcnow()
+    }, expire=None)
+    return text
+
+def read_story_text(resp, default_charset: str) -> str:
+    """Stream a Gutenberg text and return just the story, capped at MAX_TEXT_CHARS"""
+    # A charset the server declares wins. Otherwise use the one implied by the
+    # file name rather than requests' ISO-8859-1 default for text/plain (or any
+    # charset sniffing); undecodable bytes become U+FFFD
+    if "charset=" not in resp.headers.get("Content-Type", "").lower():
+        resp.encoding = default_charset
+    limit = MAX_TEXT_CHARS + GUTENBERG_HEADER_ALLOWANCE
+    buf = io.StringIO()
+    for chunk in resp.iter_content(chunk_size=65536, decode_unicode=True):
+        buf.write(chunk)
+        if buf.tell() >= limit:
+            break
+    return strip_gutenberg_boilerplate(buf.getvalue())[:MAX_TEXT_CHARS]
+
+def strip_gutenberg_boilerplate(text: str) -> str:
+    """Drop the Project Gutenberg header and footer around the story, if present"""
+    start = _GUTENBERG_START.search(text)
+    if start:
+        text = text[start.end():]
+    end = _GUTENBERG_END.search(text)
+    if end:
+        text = text[:end.start()]
+    return text.strip()
 
+@lru_cache(maxsize=1024)
 def fetch_gutenberg_metadata(book_id: int) -> dict:
-    url = f"https://www.gutenberg.org/ebooks/{book_id}"
-    resp = requests.get(url)
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    title = soup.find("meta", attrs={"property": "og:title"})["content"]
-    author = soup.find("a", rel="marcrel:aut").get_text(strip=True)
-    return {"title": title, "author": author}
+    # v2: titles/authors normalized to the RDF form (see normalize_metadata)
+    cache_key = f"meta:v2:{book_id}"
+    cached = gutenberg_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # The per-book RDF record is a few KB of XML; the landing page is only
+    # needed for the rare book without one
+    url = f"https://www.gutenberg.org/cache/epub/{book_id}/pg{book_id}.rdf"
+    resp = _gutenberg_breaker.call(_gutenberg_session.get, url, timeout=DEFAULT_HTTP_TIMEOUT)
+    metadata = None
+    if resp.status_code == 404:
+        logger.info(f"No RDF record for book {book_id}, falling back to the ebook page")
+    else:
+        resp.raise_for_status()
+        metadata = parse_metadata_rdf(resp.content)
+    
+    if metadata is None:
+        url = f"https://www.gutenberg.org/ebooks/{book_id}"
+        resp = _gutenberg_breaker.call(_gutenberg_session.get, url, timeout=DEFAULT_HTTP_TIMEOUT)
+        metadata = parse_metadata_html(resp.content)
+    
+    gutenberg_cache.set(cache_key, metadata, expire=None)
+    return metadata
+
+_RDF_NAMESPACES = {
+    "dcterms": "http://purl.org/dc/terms/",
+    "pgterms": "http://www.gutenberg.org/2009/pgterms/",
+}
+_rdf_parser = etree.XMLParser(resolve_entities=False, no_network=True)
+
+def parse_metadata_rdf(content: bytes) -> Optional[dict]:
+    """Pull the title and author out of a Gutenberg RDF record, or None if it has no title"""
+    try:
+        root = etree.fromstring(content, parser=_rdf_parser)
+    except etree.XMLSyntaxError as e:
+        logger.warning(f"Unparseable RDF record: {str(e)}")
+        return None
+    title = root.findtext(".//dcterms:title", namespaces=_RDF_NAMESPACES)
+    if not title:
+        return None
+    author = root.findtext(".//dcterms:creator//pgterms:name", namespaces=_RDF_NAMESPACES)
+    return normalize_metadata(title, author or "Unknown")
+
+def parse_metadata_html(content: bytes) -> dict:
+    """Pull the title and author out of a Gutenberg ebook page"""
+    # Raw bytes let lxml detect the charset itself
+    tree = lxml.html.fromstring(content)
+    try:
+        headline = tree.xpath('//td[@itemprop="headline"]')
+        if headline:
+            title = headline[0].text_content()
+        else:
+            # og:title reads "<title> by <author>"
+            title = tree.xpath('//meta[@property="og:title"]/@content')[0]
+            title = title.rpartition(" by ")[0] or title
+        author = tree.xpath('//a[@rel="marcrel:aut"]')[0].text_content()
+    except IndexError:
+        raise ValueError("Could not find the book's title and author")
+    return normalize_metadata(title, author)
+
+_AUTHOR_LIFE_DATES = re.compile(r",\s*[^,]*\d{3,4}[^,]*$")
+
+def normalize_metadata(title: str, author: str) -> dict:
+    """
+    Bring either metadata source to one format, so search history and trending
+    show the same title for a book whichever source answered: whitespace
+    (including multi-line RDF titles) collapsed, and the ebook page's author
+    life dates ("Barrie, J. M., 1860-1937") dropped to match the RDF name.
+    """
+    return {
+        "title": " ".join(title.split()),
+        "author": _AUTHOR_LIFE_DATES.sub("", " ".join(author.split()))
+    }
+
+# Shared analyser so the Gemini models are configured once per process
+plotter = PlotThePlot(api_key=os.environ.get('GEMINI_API_KEY'))
 
 @app.route("/api/analyze", methods=["POST"])
+@login_required
 def analyze():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Please log in to analyze books'}), 401
-    
-    try:
-        token = auth_header.split(' ')[1]
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload['user_id']
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token has expired'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token'}), 401
+    user_id = g.user.id
     
     book_id = request.json.get("book_id")
     validate_flag = request.json.get("validate", False)
+    # ?refresh=1 revalidates the cached book text and regenerates the Gemini results
+    refresh = request.args.get("refresh") == "1"
 
     if not book_id:
         return jsonify({"error": "Please provide a book ID to analyze"}), 400
     
+    # One time budget for the whole request, Gutenberg fetches included
+    deadline = time.monotonic() + ANALYZE_TIMEOUT
     try:
-        # Fetch metadata first to get the title
-        metadata = fetch_gutenberg_metadata(book_id)
-        text = fetch_gutenberg_text(book_id)
-        plotter = PlotThePlot(api_key=os.environ.get('GEMINI_API_KEY'))
-        result = plotter.analyze_text(text)
+        # The metadata is only needed after analysis, so fetch it in the background
+        metadata_future = _pool.submit(fetch_gutenberg_metadata, book_id)
+        text = fetch_gutenberg_text(book_id, refresh=refresh)
+        result = plotter.analyze_text(text, refresh=refresh, deadline=deadline)
+        metadata = metadata_future.result()
         
         if validate_flag:
-            validation_result = plotter.validate_json(text, result, metadata)
+            validation_result = plotter.validate_json(text, result, metadata, refresh=refresh, deadline=deadline)
             result["validation"] = validation_result
         
-        # Record the search in database using existing method
-        db.add_search(user_id, str(book_id), metadata['title'])
+        # Recorded by the background writer; the response doesn't wait on it
+        _search_queue.put_nowait({
+            'user_id': user_id,
+            'book_id': str(book_id),
+            'title': metadata['title'],
+            'search_date': datetime.utcnow()
+        })
         
         # Add title to response
         result["title"] = metadata['title']
         
         return jsonify(result)
+    except CircuitOpenError as e:
+        logger.warning(f"Upstream unavailable in analyze endpoint: {str(e)}")
+        return jsonify({"error": f"{str(e)}. Please try again shortly."}), 503, {"Retry-After": str(e.retry_after)}
+    except (TimeoutError, google_exceptions.DeadlineExceeded) as e:
+        logger.warning(f"Analysis timed out: {str(e)}")
+        return jsonify({"error": "Analyzing this book took too long. Please try again later."}), 504
     except ValueError as e:
         logger.warning(f"User error in analyze endpoint: {str(e)}")
         return jsonify({"error": str(e)}), 400
@@ -314,15 +737,10 @@ def analyze():
 @app.route('/api/trending', methods=['GET'])
 def get_trending():
     limit = request.args.get('limit', default=10, type=int)
-    trending = db.get_trending_books(limit)
-    return jsonify([{
-        'book_id': t.book_id,
-        'title': t.title,
-        'search_count': t.search_count,
-        'last_searched': t.last_searched.isoformat()
-    } for t in trending])
+    return trending_response(limit)
 
 @app.route('/api/share', methods=['POST'])
+@login_required
 def share_analysis():
     try:
         book_id = request.json.get('book_id')
@@ -334,17 +752,14 @@ def share_analysis():
         if not all([book_id, title, response_data]):
             return jsonify({'error': 'Book ID, title, and response data are required'}), 400
         
-        # Get user ID from token
-        token = request.headers.get('Authorization').split(' ')[1]
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload['user_id']
+        user_id = g.user.id
         
         # Create shared analysis
         shared = db.create_shared_analysis(user_id, book_id, title, response_data, note, expires_in_days)
         
         return jsonify({
             'share_id': shared.id,
-            'expires_at': shared.expires_at.isoformat() if shared.expires_at else None
+            'expires_at': shared.expires_at
         })
     except Exception as e:
         logger.error(f"Error sharing analysis: {str(e)}")
@@ -353,11 +768,32 @@ def share_analysis():
 @app.route('/api/share/<share_id>', methods=['GET'])
 def get_shared_analysis(share_id):
     try:
-        analysis = db.get_shared_analysis(share_id)
-        if not analysis:
-            return jsonify({'error': 'Shared analysis not found or expired'}), 404
+        with _share_cache_lock:
+            entry = _share_cache.get(share_id)
+        if entry and entry[2] and entry[2] < datetime.utcnow():
+            with _share_cache_lock:
+                _share_cache.pop(share_id, None)
+            entry = None
+        
+        if entry is None:
+            analysis = db.get_shared_analysis(share_id)
+            if not analysis:
+                return jsonify({'error': 'Shared analysis not found or expired'}), 404
+            body = app.json.dumps(analysis).encode('utf-8')
+            entry = (hashlib.blake2b(body, digest_size=8).hexdigest(), body, analysis['expires_at'])
+            with _share_cache_lock:
+                _share_cache[share_id] = entry
+        
+        etag, body, expires_at = entry
+        # Shares never change, but browsers mustn't keep one past its expiry
+        max_age = SHARE_MAX_AGE
+        if expires_at:
+            max_age = max(0, min(max_age, int((expires_at - datetime.utcnow()).total_seconds())))
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': f'public, max-age={max_age}, immutable'}
         
-        return jsonify(analysis)
+        if request.if_none_match.contains_weak(etag):
+            return '', 304, headers
+        return app.response_class(body, mimetype='application/json', headers=headers)
     except Exception as e:
         logger.error(f"Error retrieving shared analysis: {str(e)}")
         return jsonify({'error': 'Failed to retrieve shared analysis'}), 500